@@ -4,29 +4,114 @@
 Download Dash docsets interactively using fzf.
 """
 
+import concurrent.futures
+import contextlib
+import gzip
 import http.client
 import json
 import logging
+import os
+import queue
+import shutil
+import socket
 import subprocess
 import sys
 import tarfile
+import threading
+import time
 from pathlib import Path
-from typing import cast
+from typing import IO, cast
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
+# Docsets are downloaded concurrently, but keep the number of parallel
+# connections to kapeli.com small.
+MAX_PARALLEL_DOWNLOADS = 8
+
+# Each download thread keeps its own keep-alive connection to kapeli.com, so
+# that the TCP + TLS handshake is paid once per thread rather than per docset.
+_connections = threading.local()
+
+# All the connections above, so that Ctrl-C can interrupt blocked reads.
+_open_connections: set[http.client.HTTPSConnection] = set()
+_open_connections_lock = threading.Lock()
+
+# Set on Ctrl-C, to stop the running downloads.
+_stop = threading.Event()
+
+# Seconds to wait on kapeli.com before giving up on a stalled download.
+HTTP_TIMEOUT = 60
+
+# Read the network stream in large chunks, to avoid a lot of small socket reads
+# for docsets that can weigh GBs.
+CHUNK_SIZE = 1 << 18
+
+# How many downloaded chunks can wait for extraction before the download
+# thread blocks.
+QUEUED_CHUNKS = 16
+
+# When available, pigz decompresses docsets in a separate process, faster than
+# (and without holding the GIL like) the zlib module.
+PIGZ = shutil.which("pigz")
+
+# The list of available docsets is cached together with its ETag, so that it
+# can be revalidated cheaply and still be used for a while when offline.
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "dashp"
+FEEDS_CACHE = CACHE_DIR / "feeds.json"
+FEEDS_CACHE_MAX_AGE = 24 * 60 * 60
+
+
+def _read_feeds_cache(max_age: float | None = None) -> tuple[str, list[str]] | None:
+    """Return the cached ETag and docsets, unless missing or older than max_age."""
+    try:
+        if max_age is not None and time.time() - FEEDS_CACHE.stat().st_mtime > max_age:
+            return None
+
+        data = cast(dict[str, object], json.loads(FEEDS_CACHE.read_text()))
+        return cast(str, data["etag"]), cast(list[str], data["docsets"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _write_feeds_cache(etag: str, docsets: list[str]) -> None:
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_file = FEEDS_CACHE.with_suffix(".tmp")
+        _ = tmp_file.write_text(json.dumps({"etag": etag, "docsets": docsets}))
+        _ = tmp_file.replace(FEEDS_CACHE)
+    except OSError as e:
+        logging.warning("Failed to cache docsets: %s", e)
+
+
+def _recently_cached_docsets() -> list[str]:
+    """Fall back to a recent enough cached list of docsets, if any."""
+    if cached := _read_feeds_cache(max_age=FEEDS_CACHE_MAX_AGE):
+        logging.warning("Using cached list of docsets")
+        return cached[1]
+    return []
+
 
 def fetch_available_docsets() -> list[str]:
     """Fetch available docset names from Kapeli feeds repository."""
+    cached = _read_feeds_cache()
+
     try:
         conn = http.client.HTTPSConnection("api.github.com")
         headers = {"User-Agent": "dashp-download/1.0"}
+        if cached:
+            headers["If-None-Match"] = cached[0]
         conn.request("GET", "/repos/Kapeli/feeds/git/trees/master", headers=headers)
         response = conn.getresponse()
 
+        if cached and response.status == 304:
+            conn.close()
+            # Rewrite the cache to refresh its age, it has just been revalidated
+            _write_feeds_cache(*cached)
+            return cached[1]
+
         if response.status != 200:
             logging.error("Failed to fetch docsets: HTTP %d", response.status)
-            return []
+            return _recently_cached_docsets()
 
         response_data = response.read()
         conn.close()
@@ -44,10 +129,14 @@ def fetch_available_docsets() -> list[str]:
                 docset_name = item_path[:-4]
                 docsets.append(docset_name)
 
-        return sorted(docsets)
+        docsets.sort()
+        if etag := response.getheader("ETag"):
+            _write_feeds_cache(etag, docsets)
+
+        return docsets
     except Exception as e:
         logging.error("Failed to fetch docsets: %s", e)
-        return []
+        return _recently_cached_docsets()
 
 
 def select_docsets_with_fzf(docsets: list[str]) -> list[str]:
@@ -92,62 +181,336 @@ def select_docsets_with_fzf(docsets: list[str]) -> list[str]:
         return []
 
 
-def download_docset(docset_name: str, target_dir: Path) -> bool:
-    """Download a docset to the target directory."""
-    target_file = target_dir / f"{docset_name}.tgz"
+def _kapeli_connection() -> http.client.HTTPSConnection:
+    """Return the current thread's connection to kapeli.com."""
+    conn = cast(
+        http.client.HTTPSConnection | None, getattr(_connections, "kapeli", None)
+    )
+    if conn is None:
+        conn = http.client.HTTPSConnection("kapeli.com", timeout=HTTP_TIMEOUT)
+        _connections.kapeli = conn
+        with _open_connections_lock:
+            _open_connections.add(conn)
+    return conn
+
+
+def _discard_kapeli_connection() -> None:
+    """Close the current thread's connection so the next request reopens it."""
+    conn = cast(
+        http.client.HTTPSConnection | None, getattr(_connections, "kapeli", None)
+    )
+    if conn is not None:
+        conn.close()
+        _connections.kapeli = None
+        with _open_connections_lock:
+            _open_connections.discard(conn)
+
+
+def _stop_downloads() -> None:
+    """Stop the running downloads, including those blocked on the network."""
+    _stop.set()
+    with _open_connections_lock:
+        for conn in _open_connections:
+            if conn.sock is not None:
+                # Make blocked reads return right away
+                with contextlib.suppress(OSError):
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+
+
+def _request_docset(
+    docset_name: str, headers: dict[str, str]
+) -> http.client.HTTPResponse:
+    """GET a docset tarball, reopening the connection if the server dropped it."""
+    while True:
+        if _stop.is_set():
+            raise InterruptedError("Download interrupted")
+
+        conn = _kapeli_connection()
+        reused = conn.sock is not None
+        try:
+            conn.request("GET", f"/feeds/{docset_name}.tgz", headers=headers)
+            return conn.getresponse()
+        except ConnectionError:
+            _discard_kapeli_connection()
+            # Only a stale keep-alive connection is worth retrying
+            if not reused:
+                raise
+
+
+class _Progress:
+    """Overall progress of the running downloads, reported on a single line."""
+
+    def __init__(self):
+        self._lock: threading.Lock = threading.Lock()
+        self._downloaded: int = 0
+        self._total_size: int = 0
+
+    def start(self, total_size: int) -> None:
+        with self._lock:
+            self._total_size += total_size
+
+    def update(self, downloaded: int) -> None:
+        with self._lock:
+            self._downloaded += downloaded
+            percent = (self._downloaded / self._total_size) * 100
+            # End with a carriage return, so that the next log line
+            # overwrites the progress line
+            print(f"  Progress: {percent:5.1f}%", end="\r", file=sys.stderr)
+
+
+_progress = _Progress()
+
+
+class _ProgressReader:
+    """File-like wrapper around a response that reports download progress."""
+
+    def __init__(self, response: http.client.HTTPResponse):
+        content_length = response.getheader("Content-Length")
+        self._total_size: int = int(content_length) if content_length else 0
+        self._response: http.client.HTTPResponse = response
+        _progress.start(self._total_size)
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._response.read(size)
+        if chunk and self._total_size > 0:
+            # Only files of known size count towards the progress
+            _progress.update(len(chunk))
+        return chunk
+
+
+class _ChunkPipe:
+    """File-like object fed with chunks by one thread and read by another."""
+
+    def __init__(self):
+        self._chunks: queue.Queue[bytes] = queue.Queue(maxsize=QUEUED_CHUNKS)
+        self._buffer: bytes = b""
+        self._offset: int = 0
+        self._eof: bool = False
+        self._closed: threading.Event = threading.Event()
+
+    def feed(self, chunk: bytes) -> bool:
+        """Queue a chunk, an empty one marks the end of the stream.
+
+        Return False if the reading side has been closed.
+        """
+        while not self._closed.is_set():
+            try:
+                self._chunks.put(chunk, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            chunks = [self._buffer[self._offset :]]
+            while not self._eof:
+                chunks.append(chunk := self._chunks.get())
+                self._eof = not chunk
+            self._buffer, self._offset = b"", 0
+            return b"".join(chunks)
+
+        if self._offset >= len(self._buffer) and not self._eof:
+            self._buffer, self._offset = self._chunks.get(), 0
+            self._eof = not self._buffer
+
+        # Chunks are much larger than tarfile's reads, only copy what is
+        # returned rather than re-slicing the rest of the chunk every time
+        data = self._buffer[self._offset : self._offset + size]
+        self._offset += len(data)
+        return data
+
+    def close(self) -> None:
+        self._closed.set()
+
+    def abort(self) -> None:
+        self._closed.set()
+
+
+class _PigzPipe:
+    """Like _ChunkPipe, but decompresses the fed chunks through pigz."""
+
+    def __init__(self, pigz: str):
+        self._process: subprocess.Popen[bytes] = subprocess.Popen(
+            [pigz, "--decompress", "--stdout"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self._stdin: IO[bytes] = cast(IO[bytes], self._process.stdin)
+        self._stdout: IO[bytes] = cast(IO[bytes], self._process.stdout)
+
+    def feed(self, chunk: bytes) -> bool:
+        """Pass a chunk to pigz, an empty one marks the end of the stream.
+
+        Return False if pigz stopped reading, e.g. because it was closed.
+        """
+        try:
+            if chunk:
+                _ = self._stdin.write(chunk)
+            else:
+                self._stdin.close()
+            return True
+        except (BrokenPipeError, ValueError):
+            return False
+
+    def read(self, size: int = -1) -> bytes:
+        return self._stdout.read(size)
+
+    def close(self) -> None:
+        """Read the rest of pigz's output and check that it succeeded.
+
+        pigz only reports a corrupt stream (e.g. a CRC mismatch) when it
+        reaches its end, after the tarball itself might have been extracted.
+        """
+        while self._stdout.read(CHUNK_SIZE):
+            pass
+        self._stdout.close()
+
+        if returncode := self._process.wait():
+            raise tarfile.ReadError(f"pigz failed with exit code {returncode}")
+
+    def abort(self) -> None:
+        # pigz exits once its input is closed, or as soon as it tries writing
+        # to the closed output
+        self._stdout.close()
+        _ = self._process.wait()
+
+
+def _extract_stream(pipe: _ChunkPipe | _PigzPipe, target_dir: Path) -> list[str]:
+    """Extract the tarball read from pipe into the target directory.
+
+    Return the top-level paths that were extracted.
+    """
+    # tarfile's own "r|gz" ignores the gzip trailer, while GzipFile checks the
+    # CRC and length of the stream once it has been read up to its end
+    stream = pipe if isinstance(pipe, _PigzPipe) else gzip.GzipFile(fileobj=pipe)
+
+    try:
+        with tarfile.open(fileobj=stream, mode="r|") as tar:
+            tar.extractall(path=target_dir, filter="data")
+            paths = sorted({name.split("/")[0] for name in tar.getnames()})
+
+        # Corruption is only detected at the end of the stream, past the end
+        # of the tarball itself
+        while stream.read(CHUNK_SIZE):
+            pass
+    except BaseException:
+        pipe.abort()
+        raise
+
+    pipe.close()
+    return paths
+
+
+def _install_metadata_file(docset_name: str, target_dir: Path) -> Path:
+    return target_dir / f".{docset_name}.dashp.json"
+
+
+def _installed_version(docset_name: str, target_dir: Path) -> tuple[str, str] | None:
+    """Return the ETag and Last-Modified of the installed docset, if any.
+
+    Missing headers are returned as empty strings.
+    """
+    try:
+        metadata = cast(
+            dict[str, object],
+            json.loads(_install_metadata_file(docset_name, target_dir).read_text()),
+        )
+        etag, last_modified = metadata["etag"], metadata["last_modified"]
+        if not isinstance(etag, str) or not isinstance(last_modified, str):
+            return None
+        paths = cast(list[str], metadata["paths"])
+
+        # The docset might have been removed since it was downloaded
+        if not paths or not all((target_dir / path).exists() for path in paths):
+            return None
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    return (etag, last_modified) if etag or last_modified else None
 
+
+def download_docset(docset_name: str, target_dir: Path) -> bool:
+    """Download a docset and extract it into the target directory."""
     logging.info("Downloading %s...", docset_name)
 
     try:
-        # Download the file with progress tracking
-        conn = http.client.HTTPSConnection("kapeli.com")
-        conn.request("GET", f"/feeds/{docset_name}.tgz")
-        response = conn.getresponse()
+        installed_version = _installed_version(docset_name, target_dir)
+        metadata_file = _install_metadata_file(docset_name, target_dir)
+
+        # Only download docsets that changed since they were installed
+        headers: dict[str, str] = {}
+        if installed_version:
+            etag, last_modified = installed_version
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        response = _request_docset(docset_name, headers)
+
+        if installed_version and response.status == 304:
+            _ = response.read()
+            logging.info("%s is already up to date", docset_name)
+            return True
 
         if response.status != 200:
             logging.error(
                 "Failed to download %s: HTTP %d", docset_name, response.status
             )
-            conn.close()
+            _discard_kapeli_connection()
             return False
 
-        content_length = response.getheader("Content-Length")
-        total_size = int(content_length) if content_length is not None else 0
-
-        with open(target_file, "wb") as f:
-            if total_size > 0:
-                # Show progress for larger files
-                downloaded = 0
-                while True:
-                    chunk = response.read(8192)
-                    if not chunk:
+        version = (
+            response.getheader("ETag") or "",
+            response.getheader("Last-Modified") or "",
+        )
+        if installed_version == version:
+            # The server ignored the conditional request, skip the body
+            _discard_kapeli_connection()
+            logging.info("%s is already up to date", docset_name)
+            return True
+
+        # Forget about the installed version, the docset is about to change
+        metadata_file.unlink(missing_ok=True)
+
+        # Extract the tarball while it is being downloaded, without
+        # writing the archive itself to disk. Extraction runs on its own
+        # thread, so that decompressing and writing files overlaps with
+        # reading the next chunks from the network.
+        reader = _ProgressReader(response)
+        pipe = _PigzPipe(PIGZ) if PIGZ else _ChunkPipe()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            extraction = executor.submit(_extract_stream, pipe, target_dir)
+            try:
+                while not _stop.is_set() and (chunk := reader.read(CHUNK_SIZE)):
+                    if not pipe.feed(chunk):
                         break
-                    _ = f.write(chunk)
-                    downloaded += len(chunk)
-                    percent = (downloaded / total_size) * 100
-                    print(f"\r  Progress: {percent:.1f}%", end="", file=sys.stderr)
-                print(file=sys.stderr)  # New line after progress
-            else:
-                # No size info, just read all
-                _ = f.write(response.read())
-
-        conn.close()
-
-        # Extract the tarball
-        logging.info("Extracting %s...", docset_name)
-        with tarfile.open(target_file, "r:gz") as tar:
-            tar.extractall(path=target_dir, filter="data")
-
-        # Remove the tarball
-        target_file.unlink()
+            finally:
+                _ = pipe.feed(b"")
+
+            # Reads return early once the connection is shut down on Ctrl-C
+            if _stop.is_set():
+                raise InterruptedError("Download interrupted")
+            paths = extraction.result()
+
+        # Drain any trailing padding so that the connection can be reused
+        _ = response.read()
+
+        if any(version):
+            etag, last_modified = version
+            _ = metadata_file.write_text(
+                json.dumps(
+                    {"etag": etag, "last_modified": last_modified, "paths": paths}
+                )
+            )
 
         logging.info("Successfully installed %s", docset_name)
         return True
 
     except Exception as e:
         logging.error("Failed to install %s: %s", docset_name, e)
-        if target_file.exists():
-            target_file.unlink()
+        _discard_kapeli_connection()
         return False
 
 
@@ -181,10 +544,20 @@ def main() -> None:
         logging.info("No docsets selected.")
         sys.exit(0)
 
-    success_count = 0
-    for docset_name in selected:
-        if download_docset(docset_name, docset_dir):
-            success_count += 1
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=MAX_PARALLEL_DOWNLOADS
+    ) as executor:
+        results = executor.map(
+            lambda docset_name: download_docset(docset_name, docset_dir), selected
+        )
+        try:
+            success_count = sum(results)
+        except KeyboardInterrupt:
+            # Stop running downloads at their next chunk, skip pending ones
+            logging.info("Interrupted, stopping downloads...")
+            _stop_downloads()
+            executor.shutdown(cancel_futures=True)
+            sys.exit(130)
 
     logging.info("Downloaded %d of %d selected docsets", success_count, len(selected))
     sys.exit(0 if success_count == len(selected) else 1)
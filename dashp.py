@@ -4,83 +4,299 @@
 Merge multiple Dash docsets and search them with fzf.
 """
 
+import collections
+import concurrent.futures
 import contextlib
 import logging
+import os
+import queue
 import sqlite3
 import subprocess
 import sys
+import threading
 import re
+from collections.abc import Iterator
 from pathlib import Path
+from typing import IO, cast
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
+# https://github.com/jmymay/zealcore/commit/7a04435f65876bc5c9bb4c663e1aa3ef96197190
+DASH_ENTRY_RE = re.compile(r"<dash_entry_.*>")
 
-def merge_docsets(docsets: list[Path]) -> sqlite3.Connection:
-    with sqlite3.connect(":memory:") as db:
-        cursor = db.cursor().execute(
-            "CREATE TABLE searchIndex(id INTEGER PRIMARY KEY, name TEXT, type TEXT, docset TEXT, path TEXT);"
+# Maximum number of docsets read in parallel while indexing.
+MAX_PARALLEL_READS = 8
+
+# Number of entries written to FZF at once.
+FZF_BATCH_SIZE = 5000
+
+# Number of entries read from a docset at once, and how many batches each
+# reader may get ahead of the thread inserting them.
+INDEX_BATCH_SIZE = 5000
+QUEUED_BATCHES = 4
+
+# Merged docsets are cached across runs and only re-indexed when they change.
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "dashp"
+INDEX_CACHE = CACHE_DIR / "index.sqlite"
+
+# How long to wait, in seconds, for another run to finish indexing a docset.
+INDEX_CACHE_TIMEOUT = 60
+
+# Bump whenever SCHEMA changes, to rebuild existing caches.
+SCHEMA_VERSION = 2
+SCHEMA = """
+CREATE TABLE docsets(id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime INTEGER);
+CREATE TABLE entries(id INTEGER PRIMARY KEY, docset_id INTEGER, name TEXT, type TEXT, docset TEXT, path TEXT);
+CREATE INDEX entries_docset_id ON entries(docset_id);
+"""
+
+# A row of the entries table: docset_id, name, type, docset and path.
+Entry = tuple[int, str, str, str, str]
+
+
+def _open_index() -> sqlite3.Connection:
+    """Open the cached index, (re)creating it if missing or outdated.
+
+    Fall back to an in-memory index if the cache cannot be used.
+    """
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(INDEX_CACHE, timeout=INDEX_CACHE_TIMEOUT)
+        _ = db.execute("PRAGMA journal_mode = WAL")
+        _ = db.execute("PRAGMA synchronous = NORMAL")
+        # Indexing large docsets touches many pages, allow up to 64 MiB of cache
+        _ = db.execute("PRAGMA cache_size = -65536")
+
+        (version,) = cast(tuple[int], db.execute("PRAGMA user_version").fetchone())
+        if version != SCHEMA_VERSION:
+            _ = db.execute("BEGIN IMMEDIATE")
+            # Another run may have rebuilt the cache while we waited for the lock
+            (version,) = cast(tuple[int], db.execute("PRAGMA user_version").fetchone())
+            if version != SCHEMA_VERSION:
+                _ = db.execute("DROP TABLE IF EXISTS entries")
+                _ = db.execute("DROP TABLE IF EXISTS docsets")
+                for statement in filter(str.strip, SCHEMA.split(";")):
+                    _ = db.execute(statement)
+                _ = db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            db.commit()
+
+        return db
+    except (OSError, sqlite3.DatabaseError) as e:
+        logging.warning("Failed to open the index cache, not caching: %s", e)
+
+    db = sqlite3.connect(":memory:")
+    # The index only lives for this process, skip the rollback journal
+    _ = db.execute("PRAGMA journal_mode = OFF")
+    _ = db.executescript(SCHEMA)
+    return db
+
+
+class _EntryBatches:
+    """Batches of entries read by one thread and inserted by another."""
+
+    def __init__(self) -> None:
+        self._batches: queue.Queue[list[Entry] | None] = queue.Queue(
+            maxsize=QUEUED_BATCHES
         )
+        self._closed = threading.Event()
+
+    def put(self, batch: list[Entry] | None) -> bool:
+        """Queue a batch, or None once done; return False if no longer wanted."""
+        while not self._closed.is_set():
+            try:
+                self._batches.put(batch, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self) -> Iterator[list[Entry]]:
+        while (batch := self._batches.get()) is not None:
+            yield batch
+
+    def close(self) -> None:
+        """Stop accepting batches, unblocking the reader."""
+        self._closed.set()
+
+
+def _read_docset(docset_id: int, docset: Path) -> Iterator[list[Entry]]:
+    """Read the entries of a docset, as batches of rows of the entries table."""
+    logging.info("Indexing %s...", docset.stem)
+
+    docset_db_path = docset / "Contents/Resources/docSet.dsidx"
+    with contextlib.closing(
+        sqlite3.connect(f"file:{docset_db_path}?mode=ro", uri=True)
+    ) as docset_db:
+        try:
+            docset_cursor = docset_db.cursor().execute(
+                "SELECT name, type, path FROM searchIndex"
+            )
+
+        except sqlite3.OperationalError:
+            docset_cursor = docset_db.cursor().execute(
+                """
+                SELECT ztokenname                               AS name,
+                ztypename                                       AS type,
+                zpath || ifnull('#' || nullif(zanchor, ''), '') AS url
+                FROM ztoken
+                JOIN ztokenmetainformation
+                    ON ztokenmetainformation.z_pk = ztoken.zmetainformation
+                JOIN zfilepath
+                    ON zfilepath.z_pk = ztokenmetainformation.zfile
+                JOIN ztokentype
+                    ON ztokentype.z_pk = ztoken.ztokentype
+                """
+            )
+
+        # Concatenating strings is necessary because path could start with a
+        # leading /, build the constant part only once
+        docs_prefix = f"{docset / 'Contents/Resources/Documents'}/"
+        docset_stem = docset.stem
+
+        strip_dash_entries = DASH_ENTRY_RE.sub
+
+        def to_entry(row: tuple[str, str, str]) -> Entry:
+            name, entry_type, path = row
+            # Most paths have no entry tags, skip the regex for those
+            if "<dash_entry_" in path:
+                path = strip_dash_entries("", path)
+            return (docset_id, name, entry_type, docset_stem, docs_prefix + path)
+
+        # Yield entries in batches, so that large docsets are never all held in
+        # memory
+        while rows := cast(
+            list[tuple[str, str, str]], docset_cursor.fetchmany(INDEX_BATCH_SIZE)
+        ):
+            yield list(map(to_entry, rows))
+
+
+def _queue_docset(docset_id: int, docset: Path, batches: _EntryBatches) -> None:
+    """Read the entries of a docset into batches, for another thread to insert."""
+    try:
+        for batch in _read_docset(docset_id, docset):
+            if not batches.put(batch):
+                return
+    finally:
+        # Always signal the end, even if reading failed
+        _ = batches.put(None)
+
+
+def merge_docsets(docsets: list[Path]) -> sqlite3.Connection:
+    db = _open_index()
 
-        for docset in docsets:
+    selected: list[tuple[int]] = []
+    to_index: list[tuple[int, Path, int]] = []
+
+    with db:
+        # Docsets are cached by their absolute path
+        for docset in dict.fromkeys(docset.resolve() for docset in docsets):
             docset_db_path = docset / "Contents/Resources/docSet.dsidx"
             if not docset_db_path.exists():
                 logging.warning("Database not found for docset: %s", docset)
                 continue
 
-            with contextlib.closing(
-                sqlite3.connect(f"file:{docset_db_path}?mode=ro", uri=True)
-            ) as docset_db:
-                try:
-                    docset_cursor = docset_db.cursor().execute(
-                        "SELECT name, type, path FROM searchIndex"
-                    )
-
-                except sqlite3.OperationalError:
-                    docset_cursor = docset_db.cursor().execute(
-                        """
-                        SELECT ztokenname                               AS name,
-                        ztypename                                       AS type,
-                        zpath || ifnull('#' || nullif(zanchor, ''), '') AS url
-                        FROM ztoken
-                        JOIN ztokenmetainformation
-                            ON ztokenmetainformation.z_pk = ztoken.zmetainformation
-                        JOIN zfilepath
-                            ON zfilepath.z_pk = ztokenmetainformation.zfile
-                        JOIN ztokentype
-                            ON ztokentype.z_pk = ztoken.ztokentype
-                        """
-                    )
-
-                rows: list[tuple[str, str, str]] = docset_cursor.fetchall()
-
-                for name, entry_type, path in rows:
-                    # https://github.com/jmymay/zealcore/commit/7a04435f65876bc5c9bb4c663e1aa3ef96197190
-                    path = re.sub(r"<dash_entry_.*>", "", path)
-                    prefixed_path = (
-                        # This is necessary because path could start with a leading /
-                        f"{str(docset / 'Contents/Resources/Documents') + '/' + path}"
-                    )
-                    cursor = cursor.execute(
-                        "INSERT INTO searchIndex (name, type, docset, path) VALUES (?, ?, ?, ?)",
-                        (name, entry_type, str(docset.stem), str(prefixed_path)),
-                    )
+            # Only (re-)index docsets that are new or changed since last run
+            mtime = docset_db_path.stat().st_mtime_ns
+            # The mtime is only set once the docset has been indexed, and
+            # another run may be registering the same docset concurrently
+            _ = db.execute(
+                "INSERT OR IGNORE INTO docsets (path) VALUES (?)", (str(docset),)
+            )
+            docset_id, cached_mtime = cast(
+                tuple[int, int | None],
+                db.execute(
+                    "SELECT id, mtime FROM docsets WHERE path = ?", (str(docset),)
+                ).fetchone(),
+            )
+            selected.append((docset_id,))
+            if cached_mtime == mtime:
+                continue
+
+            to_index.append((docset_id, docset, mtime))
 
-        return db
+    def insert_entries(
+        docset_id: int,
+        mtime: int,
+        batches: _EntryBatches,
+        reader: concurrent.futures.Future[None],
+    ) -> None:
+        with db:
+            _ = db.execute("DELETE FROM entries WHERE docset_id = ?", (docset_id,))
+            for batch in batches:
+                _ = db.executemany(
+                    "INSERT INTO entries (docset_id, name, type, docset, path) VALUES (?, ?, ?, ?, ?)",
+                    batch,
+                )
+            # Roll back the partially inserted docset if reading it failed
+            reader.result()
+            _ = db.execute(
+                "UPDATE docsets SET mtime = ? WHERE id = ?", (mtime, docset_id)
+            )
+
+    # Reading docsets is independent, do it in parallel and insert the entries
+    # from this thread as they become available. Every docset is indexed in its
+    # own transaction, so that other runs do not wait for all of them. Readers
+    # hand over bounded queues of batches, and docsets are submitted as earlier
+    # ones are inserted, so that memory does not grow with the docsets' size.
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=MAX_PARALLEL_READS
+    ) as executor:
+        pending: collections.deque[
+            tuple[int, int, _EntryBatches, concurrent.futures.Future[None]]
+        ] = collections.deque()
+        try:
+            for docset_id, docset, mtime in to_index:
+                if len(pending) == MAX_PARALLEL_READS:
+                    insert_entries(*pending[0])
+                    _ = pending.popleft()
+                batches = _EntryBatches()
+                reader = executor.submit(_queue_docset, docset_id, docset, batches)
+                pending.append((docset_id, mtime, batches, reader))
+            while pending:
+                insert_entries(*pending[0])
+                _ = pending.popleft()
+        finally:
+            # Unblock the remaining readers if inserting failed
+            for _, _, batches, _ in pending:
+                batches.close()
+
+    with db:
+        # Forget about docsets that have been removed since they were cached
+        cached_docsets = cast(
+            list[tuple[int, str]], db.execute("SELECT id, path FROM docsets").fetchall()
+        )
+        for docset_id, path in cached_docsets:
+            if not Path(path).exists():
+                _ = db.execute("DELETE FROM entries WHERE docset_id = ?", (docset_id,))
+                _ = db.execute("DELETE FROM docsets WHERE id = ?", (docset_id,))
+
+        # Expose the entries of the requested docsets only, as searchIndex
+        _ = db.execute("CREATE TEMP TABLE selected_docsets(id INTEGER PRIMARY KEY)")
+        _ = db.executemany(
+            "INSERT OR IGNORE INTO selected_docsets (id) VALUES (?)", selected
+        )
+        _ = db.execute(
+            """
+            CREATE TEMP VIEW searchIndex AS
+            SELECT name, type, docset, path FROM entries
+            WHERE docset_id IN (SELECT id FROM selected_docsets)
+            """
+        )
+
+    return db
 
 
 def launch_fzf(db: sqlite3.Connection) -> str | None:
-    rows: list[tuple[str, str, str, str]] = (
-        db.cursor()
-        .execute("SELECT name, type, docset, path FROM searchIndex")
-        .fetchall()
-    )
-    fzf_input = "\n".join(
-        f"{name} ({entry_type}, {docset})\t{path}"
-        for name, entry_type, docset, path in rows
+    # Let SQLite format the lines, rather than building a tuple per row and
+    # formatting it in Python. Lines come back as UTF-8 encoded bytes, ready to
+    # be written to FZF without decoding and re-encoding them.
+    cursor = db.cursor().execute(
+        "SELECT CAST(printf('%s (%s, %s)\t%s\n', name, type, docset, path) AS BLOB)"
+        + " FROM searchIndex"
     )
 
     try:
-        fzf_process = subprocess.run(
+        with subprocess.Popen(
             [
                 "fzf",
                 "--with-nth",
@@ -94,11 +310,22 @@ def launch_fzf(db: sqlite3.Connection) -> str | None:
                 "--bind",
                 "ctrl-v:execute(echo '{-1}')+abort",
             ],
-            input=fzf_input,
-            capture_output=True,
-            text=True,
-            check=False,
-        )
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        ) as fzf_process:
+            # Stream entries to FZF as they are read, so that it can start
+            # filtering right away and the whole input is never held in memory
+            fzf_stdin = cast(IO[bytes], fzf_process.stdin)
+            try:
+                while rows := cast(
+                    list[tuple[bytes]], cursor.fetchmany(FZF_BATCH_SIZE)
+                ):
+                    _ = fzf_stdin.write(b"".join(line for (line,) in rows))
+            except BrokenPipeError:
+                # FZF exited before reading all entries
+                pass
+
+            stdout, _ = fzf_process.communicate()
 
         # Exit code 130 means FZF was interrupted with Esc or Ctrl-C
         if fzf_process.returncode == 130:
@@ -110,7 +337,7 @@ def launch_fzf(db: sqlite3.Connection) -> str | None:
             )
             sys.exit(fzf_process.returncode)
 
-        if selected_line := fzf_process.stdout.strip():
+        if selected_line := stdout.decode().strip():
             return selected_line
     except FileNotFoundError:
         logging.error("FZF is not installed.")